@@ -3,44 +3,258 @@ import streamlit as st
 import numpy as np
 from datetime import datetime
 import re
+from functools import lru_cache
 from io import BytesIO
 
+try:
+    import orjson
+except ImportError:  # optional: faster JSON export
+    orjson = None
+
+try:
+    import python_calamine  # noqa: F401
+    _EXCEL_ENGINE = 'calamine'
+except ImportError:  # optional: faster Excel parsing (pandas >= 2.2)
+    _EXCEL_ENGINE = None
+
+PERNR_COLUMNS = ['PERNR', 'Personnel Number', 'PersonnelNumber', 'EmpID', 'EmployeeID']
+_PERNR_KEYS = [col.lower() for col in PERNR_COLUMNS]
+
+# Data sheet columns needed regardless of the mapping: keys, subtype and name parts
+_DATA_SHEET_KEYS = _PERNR_KEYS + ['subty', 'vorna', 'nachn']
+
+GENDER_MAP = {'1': 'Male', 'M': 'Male', 'MALE': 'Male',
+              '2': 'Female', 'F': 'Female', 'FEMALE': 'Female'}
+
+MARITAL_MAP = {'0': 'Single', '1': 'Married', '2': 'Divorced',
+               '3': 'Widowed', '4': 'Separated'}
+
+_SUBTY_RE = re.compile(r'SUBTY[=:\s]*(\d+)', re.IGNORECASE)
+
+
+def _is_empty(value):
+    """Check a scalar for None, NaN/NA/NaT or an empty string without pd.isna"""
+    if value is None or value is pd.NA or value is pd.NaT:
+        return True
+    if isinstance(value, float):
+        return value != value
+    return isinstance(value, str) and value == ''
+
+
+def _is_date8(text):
+    """Mask of YYYYMMDD-shaped values in a string Series"""
+    return (text.str.len() == 8) & text.str.isdigit()
+
+
+def _format_dates(text):
+    """Format YYYYMMDD strings in a Series as YYYY-MM-DD"""
+    return text.str[:4] + '-' + text.str[4:6] + '-' + text.str[6:8]
+
+
+def _name_part(person_rows, column):
+    """Name column of the PA0002 rows as text, with missing names left empty"""
+    if column not in person_rows.columns:
+        return pd.Series('', index=person_rows.index)
+    return person_rows[column].fillna('').astype(str)
+
+
+def _map_or_keep(values, keys, mapping):
+    """Map keys through a dict, keeping the original value where unmapped"""
+    mapped = keys.map(mapping)
+    return mapped.where(mapped.notna(), values)
+
+
+def _gender_value(value, text):
+    return GENDER_MAP.get(text.upper(), value)
+
+
+def _marital_value(value, text):
+    return MARITAL_MAP.get(text, value)
+
+
+def _date_value(value, text):
+    if len(text) == 8 and text.isdigit():
+        return f"{text[:4]}-{text[4:6]}-{text[6:8]}"
+    return value
+
+
+def _gender_column(values):
+    return _map_or_keep(values, values.astype(str).str.upper(), GENDER_MAP)
+
+
+def _marital_column(values):
+    return _map_or_keep(values, values.astype(str), MARITAL_MAP)
+
+
+def _date_column(values):
+    text = values.astype(str)
+    is_date = _is_date8(text)
+    return values.where(~is_date, _format_dates(text[is_date]))
+
+
+# Field-name tokens with their default (scalar, column) transformations, in priority order
+_FIELD_TRANSFORMS = {
+    'GESCH': (_gender_value, _gender_column),
+    'GENDER': (_gender_value, _gender_column),
+    'FAMST': (_marital_value, _marital_column),
+    'MARITAL': (_marital_value, _marital_column),
+    'GBDAT': (_date_value, _date_column),
+    'BEGDA': (_date_value, _date_column),
+    'ENDDA': (_date_value, _date_column),
+    'DATE': (_date_value, _date_column),
+}
+
+# Mapped code fields have a handful of distinct values, so their results are categoricals
+_CATEGORICAL_TRANSFORMS = (_FIELD_TRANSFORMS['GESCH'], _FIELD_TRANSFORMS['FAMST'])
+
+
+@lru_cache(maxsize=None)
+def _field_transforms(field_name):
+    """Get the default (scalar, column) transformations implied by a field name"""
+    field_name = str(field_name).upper()
+    for token, transforms in _FIELD_TRANSFORMS.items():
+        if token in field_name:
+            return transforms
+    return None
+
+
+@st.cache_data(show_spinner=False)
+def _load_sheets(file_bytes):
+    """Parse a workbook and classify its sheets, cached on the file contents"""
+    detected = {
+        'mapping_config': None,
+        'mapping_sheet': None,
+        'mapping_columns': (None, None, None, None),
+        'data_sheets': {},
+        'lookup_tables': {},
+        'sheets': {},
+        'employee_counts': {},
+    }
+    
+    # Classify sheets from their header row so unused sheets are never parsed
+    try:
+        workbook = pd.ExcelFile(BytesIO(file_bytes), engine=_EXCEL_ENGINE)
+    except Exception:
+        # Older pandas or a workbook calamine cannot open; use the default engine
+        workbook = pd.ExcelFile(BytesIO(file_bytes))
+    data_sheet_headers = {}
+    
+    for sheet_name in workbook.sheet_names:
+        clean_name = sheet_name.strip()
+        header = pd.read_excel(workbook, sheet_name=sheet_name, nrows=0)
+        
+        # Check if this is a mapping configuration sheet
+        if SingleFileDataMapper._is_mapping_sheet(header):
+            detected['mapping_config'] = pd.read_excel(workbook, sheet_name=sheet_name)
+            detected['mapping_sheet'] = clean_name
+            detected['mapping_columns'] = SingleFileDataMapper._find_mapping_columns(detected['mapping_config'])
+        # Check if this is a data sheet
+        elif SingleFileDataMapper._is_data_sheet(header, clean_name):
+            data_sheet_headers[sheet_name] = (clean_name, header)
+        elif 'LOOKUP' in clean_name.upper() or 'REF' in clean_name.upper():
+            detected['lookup_tables'][clean_name] = pd.read_excel(workbook, sheet_name=sheet_name)
+        else:
+            # Other sheets are not used for mapping; keep only their header
+            detected['sheets'][clean_name] = header
+    
+    # Data sheets are read once the mapping is known, parsing only the columns it uses
+    source_fields = _mapping_source_fields(detected['mapping_config'], detected['mapping_columns'])
+    
+    for sheet_name, (clean_name, header) in data_sheet_headers.items():
+        usecols = None
+        if source_fields is not None:
+            needed = set(_DATA_SHEET_KEYS)
+            for source_table, source_field in source_fields:
+                if source_table in clean_name.upper() or clean_name.upper() in source_table.upper():
+                    needed.add(source_field)
+            usecols = lambda col, needed=needed: str(col).lower() in needed
+        
+        # Personnel numbers are identifiers, so read them as text; other columns are
+        # converted to Arrow-backed dtypes, which store text far more compactly than object
+        # columns. Converting after the read (rather than read_excel's dtype_backend) leaves
+        # columns mixing numbers and text as object instead of failing the whole sheet
+        pernr_dtypes = {col: 'string[pyarrow]' for col in header.columns if str(col).lower() in _PERNR_KEYS}
+        df = pd.read_excel(
+            workbook, sheet_name=sheet_name, usecols=usecols, dtype=pernr_dtypes
+        ).convert_dtypes(dtype_backend='pyarrow')
+        detected['data_sheets'][clean_name] = df
+        
+        # Summaries shown in the source data preview are cached with the workbook
+        if 'PERNR' in df.columns:
+            detected['employee_counts'][clean_name] = df['PERNR'].nunique()
+    
+    return detected
+
+
+def _mapping_source_fields(mapping_config, mapping_columns):
+    """List the (source table, lower-cased source field) pairs a mapping reads"""
+    if mapping_config is None:
+        return None
+    
+    target_col, source_table_col, source_field_col, _ = mapping_columns
+    if not all([target_col, source_table_col, source_field_col]):
+        return None
+    
+    rules = mapping_config[[source_table_col, source_field_col]].dropna()
+    return [(str(table), str(field).lower()) for table, field in rules.itertuples(index=False)]
+
+
 class SingleFileDataMapper:
     def __init__(self, excel_file):
         self.excel_file = excel_file
+        self.file_bytes = None
         self.sheets = {}
         self.mapping_config = None
+        self.mapping_columns = (None, None, None, None)
         self.data_sheets = {}
         self.lookup_tables = {}
+        self.employee_counts = {}
+        self._pernr_cols = {}
+        self._indexed_sheets = {}
+        self._pernr_positions = {}
+        self._subtype_positions = {}
+        self._col_maps = {}
+        self._sheet_by_table = {}
+        self._first_rows = {}
+        self._rule_cache = {}
         
     def load_and_detect_sheets(self):
         """Load Excel file and auto-detect sheet types"""
         try:
-            # Read all sheets
-            all_sheets = pd.read_excel(self.excel_file, sheet_name=None)
+            if hasattr(self.excel_file, 'getvalue'):
+                file_bytes = self.excel_file.getvalue()
+            else:
+                with open(self.excel_file, 'rb') as f:
+                    file_bytes = f.read()
             
-            for sheet_name, df in all_sheets.items():
-                clean_name = sheet_name.strip()
-                
-                # Check if this is a mapping configuration sheet
-                if self._is_mapping_sheet(df):
-                    self.mapping_config = df
-                    st.success(f"Found mapping configuration in sheet: {clean_name}")
-                # Check if this is a data sheet
-                elif self._is_data_sheet(df, clean_name):
-                    self.data_sheets[clean_name] = df
-                    st.success(f"Found data sheet: {clean_name}")
-                elif 'LOOKUP' in clean_name.upper() or 'REF' in clean_name.upper():
-                    self.lookup_tables[clean_name] = df
-                else:
-                    self.sheets[clean_name] = df
+            self.file_bytes = file_bytes
+            detected = _load_sheets(file_bytes)
+            
+            self.mapping_config = detected['mapping_config']
+            self.mapping_columns = detected['mapping_columns']
+            if self.mapping_config is not None:
+                st.success(f"Found mapping configuration in sheet: {detected['mapping_sheet']}")
+            
+            self._sheet_by_table.clear()
+            self._pernr_positions.clear()
+            self._subtype_positions.clear()
+            self._first_rows.clear()
+            for clean_name, df in detected['data_sheets'].items():
+                self.data_sheets[clean_name] = df
+                self._index_data_sheet(clean_name, df)
+                st.success(f"Found data sheet: {clean_name}")
+            
+            self.lookup_tables.update(detected['lookup_tables'])
+            self.sheets.update(detected['sheets'])
+            self.employee_counts.update(detected['employee_counts'])
             
             return True
         except Exception as e:
             st.error(f"Error loading Excel file: {str(e)}")
             return False
     
-    def _is_mapping_sheet(self, df):
+    @staticmethod
+    def _is_mapping_sheet(df):
         """Check if dataframe is a mapping configuration sheet"""
         columns = [col.lower() for col in df.columns]
         # Look for key mapping columns
@@ -48,7 +262,8 @@ class SingleFileDataMapper:
         has_source = any('source' in col and ('table' in col or 'field' in col) for col in columns)
         return has_target and has_source
     
-    def _is_data_sheet(self, df, sheet_name):
+    @staticmethod
+    def _is_data_sheet(df, sheet_name):
         """Check if dataframe is a data sheet"""
         # Check for PERNR column (personnel number)
         has_pernr = 'PERNR' in df.columns
@@ -56,53 +271,142 @@ class SingleFileDataMapper:
         is_pa_sheet = sheet_name.upper().startswith('PA0')
         return has_pernr or is_pa_sheet
     
+    @staticmethod
+    def _find_mapping_columns(mapping_config):
+        """Find the target, source table, source field and notes columns of a mapping sheet"""
+        target_col = None
+        source_table_col = None
+        source_field_col = None
+        notes_col = None
+        
+        for col in mapping_config.columns:
+            col_lower = col.lower()
+            if 'target column' in col_lower and 'successfactor' in col_lower:
+                target_col = col
+            elif 'source table' in col_lower:
+                source_table_col = col
+            elif 'technical field' in col_lower or ('source field' in col_lower and 'ecc' in col_lower):
+                source_field_col = col
+            elif 'notes' in col_lower or 'transformation' in col_lower:
+                notes_col = col
+        
+        return target_col, source_table_col, source_field_col, notes_col
+    
+    def _index_data_sheet(self, sheet_name, df):
+        """Index a data sheet by personnel number once so lookups avoid full scans"""
+        col_map = {str(col).lower(): col for col in df.columns}
+        self._col_maps[sheet_name] = col_map
+        
+        pernr_col = next((col_map[key] for key in _PERNR_KEYS if key in col_map), None)
+        if pernr_col is None:
+            return
+        
+        # String keys keep int/str personnel numbers comparable
+        pernr_keys = df[pernr_col].astype(str)
+        self._pernr_cols[sheet_name] = pernr_col
+        self._indexed_sheets[sheet_name] = df.set_index(pernr_keys, drop=False)
+    
+    def _row_positions(self, sheet_name, by_subtype=False):
+        """Row positions per employee (or per employee and subtype), built on first use
+        
+        Only single-value lookups need these, so sheets loaded on a rerun don't pay for them.
+        """
+        positions = self._subtype_positions if by_subtype else self._pernr_positions
+        if sheet_name not in positions:
+            df = self._indexed_sheets[sheet_name]
+            keys = [df.index.to_numpy(), df['SUBTY'].to_numpy()] if by_subtype else df.index.to_numpy()
+            positions[sheet_name] = df.groupby(keys, sort=False).indices
+        return positions[sheet_name]
+    
+    def _resolve_column(self, sheet_name, field):
+        """Resolve a field name to the actual column name of a data sheet"""
+        if field in self.data_sheets[sheet_name].columns:
+            return field
+        return self._col_maps[sheet_name].get(str(field).lower())
+    
+    def _find_data_sheet(self, source_table):
+        """Find the name of the data sheet matching a source table"""
+        if source_table in self._sheet_by_table:
+            return self._sheet_by_table[source_table]
+        
+        # Substring match in sheet order, remembered per source table
+        match = None
+        for sheet_name in self.data_sheets:
+            if source_table in sheet_name.upper() or sheet_name.upper() in source_table.upper():
+                match = sheet_name
+                break
+        self._sheet_by_table[source_table] = match
+        return match
+    
+    def _subtype_from_notes(self, notes):
+        """Get the subtype a mapping rule filters on, if its notes mention SUBTY"""
+        if isinstance(notes, str) and 'SUBTY' in notes:
+            return self._extract_subtype_from_notes(notes)
+        return None
+    
+    def _filter_subtype(self, emp_data, subtype=None):
+        """Restrict rows to the given subtype"""
+        if subtype and 'SUBTY' in emp_data.columns:
+            emp_data = emp_data[emp_data['SUBTY'] == int(subtype)]
+        return emp_data
+    
     def get_source_value(self, personnel_number, source_table, source_field, subtype=None, notes=""):
         """Get value from source table for specific personnel number"""
         # Find the matching data sheet
-        target_sheet = None
-        for sheet_name, df in self.data_sheets.items():
-            if source_table in sheet_name.upper() or sheet_name.upper() in source_table.upper():
-                target_sheet = df
-                break
+        target_name = self._find_data_sheet(source_table)
         
-        if target_sheet is None:
+        if target_name is None or target_name not in self._indexed_sheets:
             return None
         
-        # Handle different personnel number column names
-        pernr_col = None
-        for col in ['PERNR', 'Personnel Number', 'PersonnelNumber', 'EmpID', 'EmployeeID']:
-            if col in target_sheet.columns:
-                pernr_col = col
-                break
-        
-        if pernr_col is None:
+        column = self._resolve_column(target_name, source_field)
+        if column is None:
             return None
         
-        # Convert personnel number to string for comparison
-        target_sheet = target_sheet.copy()
-        target_sheet[pernr_col] = target_sheet[pernr_col].astype(str)
+        # Look up the employee's rows, narrowed to the subtype for communication
+        # and address data, via the precomputed row positions
         personnel_number = str(personnel_number)
+        subtype_value = subtype or self._subtype_from_notes(notes)
+        if subtype_value and 'SUBTY' in self._indexed_sheets[target_name].columns:
+            positions = self._row_positions(target_name, by_subtype=True).get(
+                (personnel_number, int(subtype_value))
+            )
+        else:
+            positions = self._row_positions(target_name).get(personnel_number)
+        
+        if positions is None or len(positions) == 0:
+            return None
         
-        # Filter by personnel number
-        emp_data = target_sheet[target_sheet[pernr_col] == personnel_number]
+        # Get the field value
+        value = self._indexed_sheets[target_name][column].iat[positions[0]]
+        return value if not pd.isna(value) else None
+    
+    def _resolve_source(self, source_table, source_field):
+        """Resolve a source table and field to an indexed data sheet and column"""
+        sheet_name = self._find_data_sheet(source_table)
         
-        if emp_data.empty:
+        if sheet_name is None or sheet_name not in self._indexed_sheets:
             return None
         
-        # Handle subtype filtering for communication and address data
-        if subtype or 'SUBTY' in notes:
-            subtype_value = self._extract_subtype_from_notes(notes) if not subtype else subtype
-            if subtype_value and 'SUBTY' in emp_data.columns:
-                emp_data = emp_data[emp_data['SUBTY'] == int(subtype_value)]
-                if emp_data.empty:
-                    return None
-        
-        # Get the field value
-        if source_field in emp_data.columns:
-            value = emp_data.iloc[0][source_field]
-            return value if not pd.isna(value) else None
+        column = self._resolve_column(sheet_name, source_field)
+        if column is None:
+            return None
         
-        return None
+        return sheet_name, column
+    
+    def _source_column(self, pernr_keys, sheet_name, column, subtype=None):
+        """Get a resolved source column for all personnel numbers"""
+        # First matching row per employee, kept per (sheet, column, subtype) so rules
+        # reading the same view (e.g. email and login from PA0105 SUBTY 10) share it;
+        # object dtype keeps integer codes from being upcast to float for missing employees
+        key = (sheet_name, column, subtype)
+        first_rows = self._first_rows.get(key)
+        if first_rows is None:
+            source = self._filter_subtype(self._indexed_sheets[sheet_name], subtype)
+            first_rows = source[column][~source.index.duplicated(keep='first')].astype(object)
+            self._first_rows[key] = first_rows
+        
+        # Aligned to the requested personnel numbers
+        return first_rows.reindex(pernr_keys)
     
     def _extract_subtype_from_notes(self, notes):
         """Extract subtype number from notes field"""
@@ -110,74 +414,105 @@ class SingleFileDataMapper:
             return None
         
         # Look for patterns like SUBTY=0010, SUBTY=10, etc.
-        match = re.search(r'SUBTY[=:\s]*(\d+)', notes.upper())
+        match = _SUBTY_RE.search(notes)
         if match:
             return match.group(1).lstrip('0') or '0'  # Remove leading zeros but keep single 0
         
         # Look for specific mentions
-        if 'EMAIL' in notes.upper():
+        notes_upper = notes.upper()
+        if 'EMAIL' in notes_upper:
             return '10'  # Email subtype
-        elif 'PHONE' in notes.upper():
+        elif 'PHONE' in notes_upper:
             return '20'  # Phone subtype
         
         return None
     
     def apply_transformation(self, value, transformation_rule, field_name="", person_row=None):
         """Apply transformation based on rule and field context"""
-        if pd.isna(value) or value == '':
+        if _is_empty(value):
             return None
             
-        if not transformation_rule or pd.isna(transformation_rule):
+        # Stringify once; every check below works on the same text
+        text = value if isinstance(value, str) else str(value)
+        
+        if not transformation_rule or _is_empty(transformation_rule):
             # Apply default transformations based on field name
-            return self._apply_default_transformations(value, field_name, person_row)
+            return self._apply_default_transformations(value, field_name, person_row, text)
         
         rule = str(transformation_rule)
         
-        # Date transformation
-        if 'date' in rule.lower() or len(str(value)) == 8:
-            try:
-                date_str = str(value)
-                if len(date_str) == 8 and date_str.isdigit():
-                    return f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:8]}"
-            except:
-                pass
+        # Date transformation (only YYYYMMDD values are reformatted, whatever the rule says)
+        if len(text) == 8 and text.isdigit():
+            return f"{text[:4]}-{text[4:6]}-{text[6:8]}"
         
         # Concatenation for display name
         if 'concatenate' in rule.lower() and person_row is not None:
             if 'VORNA' in rule and 'NACHN' in rule:
-                first_name = person_row.get('VORNA', '') or ''
-                last_name = person_row.get('NACHN', '') or ''
+                first_name = person_row.get('VORNA', '')
+                last_name = person_row.get('NACHN', '')
+                first_name = '' if _is_empty(first_name) else first_name
+                last_name = '' if _is_empty(last_name) else last_name
                 return f"{first_name} {last_name}".strip()
         
         # Apply default transformations
-        return self._apply_default_transformations(value, field_name, person_row)
+        return self._apply_default_transformations(value, field_name, person_row, text)
     
-    def _apply_default_transformations(self, value, field_name="", person_row=None):
+    def _apply_default_transformations(self, value, field_name="", person_row=None, text=None):
         """Apply default transformations based on field name patterns"""
-        field_name = field_name.upper()
-        
-        # Gender transformation
-        if 'GESCH' in field_name or 'GENDER' in field_name.upper():
-            gender_map = {'1': 'Male', 'M': 'Male', 'MALE': 'Male',
-                         '2': 'Female', 'F': 'Female', 'FEMALE': 'Female'}
-            return gender_map.get(str(value).upper(), value)
-        
-        # Marital status transformation
-        if 'FAMST' in field_name or 'MARITAL' in field_name.upper():
-            marital_map = {'0': 'Single', '1': 'Married', '2': 'Divorced', 
-                          '3': 'Widowed', '4': 'Separated'}
-            return marital_map.get(str(value), value)
-        
-        # Date fields
-        if any(date_field in field_name for date_field in ['GBDAT', 'BEGDA', 'ENDDA', 'DATE']):
-            if len(str(value)) == 8 and str(value).isdigit():
-                try:
-                    date_str = str(value)
-                    return f"{date_str[:4]}-{date_str[4:6]}-{date_str[6:8]}"
-                except:
-                    pass
-        
-        return value
+        transforms = _field_transforms(field_name)
+        if transforms is None:
+            return value
+        
+        if text is None:
+            text = value if isinstance(value, str) else str(value)
+        return transforms[0](value, text)
+    
+    def _compile_rule(self, transformation_rule, field_name=""):
+        """Compile a transformation rule into a function over a whole column
+        
+        The returned function takes the source values (object Series) and the
+        aligned PA0002 rows, and mirrors apply_transformation for every value.
+        """
+        has_rule = bool(transformation_rule) and not _is_empty(transformation_rule)
+        rule = str(transformation_rule) if has_rule else None
+        
+        cache_key = (rule, field_name)
+        if cache_key in self._rule_cache:
+            return self._rule_cache[cache_key]
+        
+        default = self._compile_default_transformations(field_name)
+        
+        if rule is None:
+            transform = default
+        else:
+            concatenate = 'concatenate' in rule.lower() and 'VORNA' in rule and 'NACHN' in rule
+            
+            def transform(values, person_rows):
+                text = values.astype(str)
+                
+                # Concatenation for display name
+                if concatenate and person_rows is not None:
+                    first_name = _name_part(person_rows, 'VORNA')
+                    last_name = _name_part(person_rows, 'NACHN')
+                    result = first_name.str.cat(last_name, sep=' ').str.strip()
+                else:
+                    result = default(values, person_rows)
+                
+                # Date transformation takes precedence for YYYYMMDD values
+                is_date = _is_date8(text)
+                return result.where(~is_date, _format_dates(text[is_date]))
+        
+        self._rule_cache[cache_key] = transform
+        return transform
+    
+    def _compile_default_transformations(self, field_name=""):
+        """Compile the field-name based default transformations for a whole column"""
+        transforms = _field_transforms(field_name)
+        if transforms is None:
+            return lambda values, person_rows: values
+        
+        column_transform = transforms[1]
+        return lambda values, person_rows: column_transform(values)
     
     def transform_data(self):
         """Transform data according to mapping configuration"""
@@ -186,124 +521,199 @@ class SingleFileDataMapper:
             return None
         
         # Get PA0002 data (personal data)
-        pa0002_data = None
-        for sheet_name, df in self.data_sheets.items():
+        pa0002_name = None
+        for sheet_name in self.data_sheets:
             if 'PA0002' in sheet_name.upper() or 'PERSONAL' in sheet_name.upper():
-                pa0002_data = df
+                pa0002_name = sheet_name
                 break
         
-        if pa0002_data is None:
+        if pa0002_name is None:
             st.error("PA0002 (Personal Data) sheet not found")
             return None
         
-        # Find personnel number column
-        pernr_col = None
-        for col in ['PERNR', 'Personnel Number', 'PersonnelNumber', 'EmpID']:
-            if col in pa0002_data.columns:
-                pernr_col = col
-                break
+        pa0002_data = self.data_sheets[pa0002_name]
+        pa0002_indexed = self._indexed_sheets.get(pa0002_name)
+        pernr_col = self._pernr_cols.get(pa0002_name)
         
         if pernr_col is None:
             st.error("Personnel number column not found in PA0002")
             return None
         
-        # Get unique personnel numbers
-        personnel_numbers = pa0002_data[pernr_col].dropna().unique()
+        # Get unique personnel numbers; dropping nulls after unique() avoids copying the column
+        personnel_numbers = pa0002_data[pernr_col].unique()
+        personnel_numbers = personnel_numbers[pd.notna(personnel_numbers)]
         st.info(f"Processing {len(personnel_numbers)} employees...")
         
-        # Find column names in mapping config
-        target_col = None
-        source_table_col = None
-        source_field_col = None
-        notes_col = None
-        
-        for col in self.mapping_config.columns:
-            col_lower = col.lower()
-            if 'target column' in col_lower and 'successfactor' in col_lower:
-                target_col = col
-            elif 'source table' in col_lower:
-                source_table_col = col
-            elif 'technical field' in col_lower or ('source field' in col_lower and 'ecc' in col_lower):
-                source_field_col = col
-            elif 'notes' in col_lower or 'transformation' in col_lower:
-                notes_col = col
+        # Mapping config columns are resolved once when the workbook is loaded
+        target_col, source_table_col, source_field_col, notes_col = self.mapping_columns
         
         if not all([target_col, source_table_col, source_field_col]):
             st.error("Could not find required columns in mapping configuration")
             return None
         
-        # Process each employee
-        result_data = []
-        
-        progress_bar = st.progress(0)
-        
-        for idx, pernr in enumerate(personnel_numbers):
-            if pd.isna(pernr):
+        # Parse each rule's subtype once up front rather than while fetching columns
+        notes_values = self.mapping_config[notes_col] if notes_col else pd.Series('', index=self.mapping_config.index)
+        self._compiled_mappings = pd.DataFrame({
+            'target_field': self.mapping_config[target_col],
+            'source_table': self.mapping_config[source_table_col],
+            'source_field': self.mapping_config[source_field_col],
+            'notes': notes_values,
+            'subtype': pd.Series([self._subtype_from_notes(notes) for notes in notes_values],
+                                 index=self.mapping_config.index, dtype=object),
+        })
+        
+        # Resolve every rule once: rules without a usable source are written as None.
+        # When a target field is mapped more than once the last rule wins, so earlier
+        # rules only reserve the field's column position and are never resolved
+        is_last_rule = ~self._compiled_mappings['target_field'].duplicated(keep='last').to_numpy()
+        plan = {}
+        rules = self._compiled_mappings.itertuples(index=False)
+        for is_last, (target_field, source_table, source_field, notes, subtype) in zip(is_last_rule, rules):
+            if pd.isna(target_field) or target_field.strip() == '':
+                continue
+            if not is_last:
+                plan.setdefault(target_field, None)
                 continue
             
-            row_data = {}
-            
-            # Get person's PA0002 record for transformations
-            person_pa0002 = pa0002_data[pa0002_data[pernr_col] == pernr]
-            person_row = person_pa0002.iloc[0] if not person_pa0002.empty else None
-            
-            # Process each mapping rule
-            for _, mapping_row in self.mapping_config.iterrows():
-                target_field = mapping_row.get(target_col)
-                source_table = mapping_row.get(source_table_col)
-                source_field = mapping_row.get(source_field_col)
-                notes = mapping_row.get(notes_col, '') if notes_col else ''
-                
-                if pd.isna(target_field) or target_field.strip() == '':
-                    continue
-                
-                # Get source value
-                if pd.isna(source_table) or pd.isna(source_field):
-                    value = None
-                else:
-                    value = self.get_source_value(pernr, source_table, source_field, notes=notes)
-                
-                # Apply transformations
-                if value is not None:
-                    value = self.apply_transformation(value, notes, source_field, person_row)
-                
-                row_data[target_field] = value
-            
-            result_data.append(row_data)
+            source = None
+            if not (pd.isna(source_table) or pd.isna(source_field)):
+                source = self._resolve_source(source_table, source_field)
             
-            # Update progress
-            progress_bar.progress((idx + 1) / len(personnel_numbers))
+            plan[target_field] = {
+                'target': target_field,
+                'source': source,
+                'subtype': subtype,
+                'transform': self._compile_rule(notes, source_field) if source else None,
+                'categorical': _field_transforms(source_field) in _CATEGORICAL_TRANSFORMS,
+            }
+        plan = list(plan.values())
+        
+        # Process one mapping rule at a time, producing a whole column per rule
+        pernr_keys = pd.Index(personnel_numbers).astype(str)
+        person_rows = None
+        if any(step['source'] for step in plan):
+            person_rows = pa0002_indexed[~pa0002_indexed.index.duplicated(keep='first')].reindex(pernr_keys)
+        
+        columns = {}
+        
+        progress_bar = st.progress(0)
         
-        result_df = pd.DataFrame(result_data)
+        for idx, step in enumerate(plan):
+            progress_bar.progress((idx + 1) / len(plan))
+            columns[step['target']] = self._rule_column(step, pernr_keys, person_rows)
         
-        # Replace NaN with None for cleaner display
-        result_df = result_df.where(pd.notnull(result_df), None)
+        # Columns are in employee order with None for missing values; wrapping them as
+        # object Series stops pandas 3 from inferring str dtype, which would turn None into NaN
+        result_df = pd.DataFrame(columns)
         
         st.success(f"✅ Successfully transformed {len(result_df)} employee records!")
         return result_df
     
+    def _rule_column(self, step, pernr_keys, person_rows):
+        """Produce one transformed result column from a planned mapping rule"""
+        if step['source'] is None:
+            return pd.Series(np.full(len(pernr_keys), None, dtype=object), dtype=object)
+        
+        # Get source values for every employee
+        sheet_name, column = step['source']
+        source_values = self._source_column(pernr_keys, sheet_name, column, step['subtype'])
+        
+        # Apply transformations to the whole column, leaving empty values as None; some
+        # transforms (e.g. concatenation) return str Series, where None would become NaN
+        has_value = source_values.notna() & (source_values != '')
+        transformed = step['transform'](source_values, person_rows).astype(object).where(has_value, None)
+        # Unmapped codes are kept as raw values, and a category mixing them with mapped
+        # text cannot be displayed, so only fully textual results become categoricals
+        if step['categorical'] and pd.api.types.infer_dtype(transformed, skipna=True) == 'string':
+            return pd.Categorical(transformed)
+        return pd.Series(transformed.to_numpy(dtype=object), dtype=object)
+    
     def get_data_quality_report(self, transformed_data):
         """Generate data quality report"""
         if transformed_data is None:
             return {}
         
         total_records = len(transformed_data)
+        counts = transformed_data.count()
+        completeness = (counts / total_records * 100).round(2) if total_records > 0 else counts * 0.0
+        
         report = {
             'total_records': total_records,
-            'field_completeness': {}
-        }
-        
-        for col in transformed_data.columns:
-            non_null_count = transformed_data[col].count()
-            completeness = (non_null_count / total_records) * 100 if total_records > 0 else 0
-            report['field_completeness'][col] = {
-                'non_null_count': non_null_count,
-                'completeness_percent': round(completeness, 2)
+            'field_completeness': {
+                col: {
+                    'non_null_count': int(counts[col]),
+                    'completeness_percent': float(completeness[col])
+                }
+                for col in counts.index
             }
+        }
         
         return report
 
 # Streamlit Interface
+@st.cache_data(show_spinner=False)
+def _transform_cached(_mapper, file_bytes):
+    """Run a loaded mapper's transform, cached on the workbook it was loaded from"""
+    return _mapper.transform_data()
+
+def _write_sheet(workbook, sheet_name, df, header_format):
+    """Write a DataFrame to a new worksheet row by row, header first"""
+    worksheet = workbook.add_worksheet(sheet_name)
+    worksheet.write_row(0, 0, [str(col) for col in df.columns], header_format)
+    
+    # xlsxwriter writes None as an empty cell but rejects NaN/NA
+    values = df.astype(object).where(df.notna(), None)
+    for row_idx, row in enumerate(values.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(row_idx, 0, row)
+
+@st.cache_data(show_spinner=False)
+def _to_excel_bytes(transformed_data, completeness_df):
+    """Serialize the transformed data and quality report to xlsx bytes"""
+    import xlsxwriter
+    
+    # Rows are written in order, so constant_memory can flush each row as it goes;
+    # datetimes get the same cell format pandas' to_excel gives them
+    buffer = BytesIO()
+    workbook = xlsxwriter.Workbook(buffer, {'constant_memory': True,
+                                            'default_date_format': 'yyyy-mm-dd hh:mm:ss'})
+    # Same header style pandas' to_excel uses
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    _write_sheet(workbook, 'Transformed_Data', transformed_data, header_format)
+    _write_sheet(workbook, 'Quality_Report', completeness_df, header_format)
+    workbook.close()
+    return buffer.getvalue()
+
+@st.cache_data(show_spinner=False)
+def _to_csv_bytes(transformed_data):
+    """Serialize the transformed data to CSV bytes"""
+    # Writing into a binary buffer encodes as it goes, with no intermediate str copy
+    buffer = BytesIO()
+    transformed_data.to_csv(buffer, index=False, encoding='utf-8')
+    return buffer.getvalue()
+
+def _json_default(value):
+    """Serialize values orjson leaves to us the way DataFrame.to_json does"""
+    if value is pd.NaT:
+        return None
+    if isinstance(value, datetime):
+        # to_json writes datetimes as epoch milliseconds
+        return pd.Timestamp(value).value // 1_000_000
+    return str(value)
+
+@st.cache_data(show_spinner=False)
+def _to_json_bytes(transformed_data):
+    """Serialize the transformed data to JSON records bytes"""
+    if orjson is None:
+        return transformed_data.to_json(orient='records').encode('utf-8')
+    
+    # orjson writes NaN as null, matching DataFrame.to_json; datetimes (and NaT) are
+    # passed through to _json_default so they match it too
+    return orjson.dumps(
+        transformed_data.to_dict(orient='records'),
+        option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_PASSTHROUGH_DATETIME,
+        default=_json_default
+    )
+
 def main():
     st.set_page_config(
         page_title="HR Data Mapping Tool - Fixed",
@@ -360,9 +770,8 @@ def main():
                         st.write(f"**{sheet_name}** - {len(df)} rows, {len(df.columns)} columns")
                         
                         # Show unique employee count if PERNR exists
-                        if 'PERNR' in df.columns:
-                            unique_count = df['PERNR'].nunique()
-                            st.write(f"Unique employees: {unique_count}")
+                        if sheet_name in mapper.employee_counts:
+                            st.write(f"Unique employees: {mapper.employee_counts[sheet_name]}")
                         
                         st.dataframe(df.head(5), use_container_width=True)
             
@@ -371,14 +780,17 @@ def main():
             
             if st.button("Transform Data", type="primary", use_container_width=True):
                 with st.spinner("Transforming data... This may take a few minutes for large datasets."):
-                    transformed_data = mapper.transform_data()
+                    transformed_data = _transform_cached(mapper, mapper.file_bytes)
                     
                     if transformed_data is not None:
                         st.success("🎉 Data transformation completed!")
                         
-                        # Show results
+                        # Show results; only a preview is sent to the browser, the downloads have everything
                         st.subheader("📋 Transformed Data")
-                        st.dataframe(transformed_data, use_container_width=True)
+                        st.dataframe(transformed_data.head(20), use_container_width=True)
+                        if len(transformed_data) > 20:
+                            st.caption(f"Showing the first 20 of {len(transformed_data)} records. "
+                                       "Download the results for the full data.")
                         
                         # Data quality report
                         quality_report = mapper.get_data_quality_report(transformed_data)
@@ -389,62 +801,55 @@ def main():
                         with col1:
                             st.metric("Total Records", quality_report['total_records'])
                         
+                        # Field completeness details, one row per field
+                        completeness_df = (
+                            pd.DataFrame.from_dict(quality_report['field_completeness'], orient='index',
+                                                   columns=['non_null_count', 'completeness_percent'])
+                            .rename(columns={'non_null_count': 'Records with Data',
+                                             'completeness_percent': 'Completeness %'})
+                            .rename_axis('Field')
+                            .reset_index()
+                        )
+                        
                         with col2:
-                            avg_completeness = np.mean([field['completeness_percent'] 
-                                                      for field in quality_report['field_completeness'].values()])
+                            avg_completeness = completeness_df['Completeness %'].mean()
                             st.metric("Average Completeness", f"{avg_completeness:.1f}%")
                         
-                        # Field completeness details
-                        completeness_data = []
-                        for field, stats in quality_report['field_completeness'].items():
-                            completeness_data.append({
-                                'Field': field,
-                                'Records with Data': stats['non_null_count'],
-                                'Completeness %': stats['completeness_percent']
-                            })
-                        
-                        completeness_df = pd.DataFrame(completeness_data)
                         st.dataframe(
                             completeness_df.sort_values('Completeness %', ascending=False),
                             use_container_width=True
                         )
                         
-                        # Download options
+                        # Download options, sharing one timestamp across the file names
                         st.subheader("💾 Download Results")
+                        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
                         
                         col1, col2, col3 = st.columns(3)
                         
                         with col1:
                             # Excel download
-                            buffer = BytesIO()
-                            with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-                                transformed_data.to_excel(writer, sheet_name='Transformed_Data', index=False)
-                                completeness_df.to_excel(writer, sheet_name='Quality_Report', index=False)
-                            
                             st.download_button(
                                 label="📊 Download Excel",
-                                data=buffer.getvalue(),
-                                file_name=f"hr_transformed_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+                                data=_to_excel_bytes(transformed_data, completeness_df),
+                                file_name=f"hr_transformed_{timestamp}.xlsx",
                                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                                 use_container_width=True
                             )
                         
                         with col2:
-                            csv_data = transformed_data.to_csv(index=False)
                             st.download_button(
                                 label="📝 Download CSV",
-                                data=csv_data,
-                                file_name=f"hr_transformed_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                                data=_to_csv_bytes(transformed_data),
+                                file_name=f"hr_transformed_{timestamp}.csv",
                                 mime="text/csv",
                                 use_container_width=True
                             )
                         
                         with col3:
-                            json_data = transformed_data.to_json(orient='records', indent=2)
                             st.download_button(
                                 label="🔗 Download JSON",
-                                data=json_data,
-                                file_name=f"hr_transformed_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.json",
+                                data=_to_json_bytes(transformed_data),
+                                file_name=f"hr_transformed_{timestamp}.json",
                                 mime="application/json",
                                 use_container_width=True
                             )